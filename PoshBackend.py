@@ -1,17 +1,25 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Annotated
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 import jwt
+from jwt.utils import base64url_decode, base64url_encode
 from fastapi import Depends, FastAPI, HTTPException, status, Form, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError
+from cachetools import TTLCache
+from pybloom_live import ScalableBloomFilter
+import orjson
+import asyncio
+import hashlib
+import hmac
+import threading
+import time
 import uuid
 import os
-import re
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -24,7 +32,15 @@ MONGO_URI = os.getenv("MONGO_URI")
 if not MONGO_URI:
     raise ValueError("MONGO_URI environment variable is not set")
 
-client = MongoClient(MONGO_URI)
+client = AsyncMongoClient(
+    MONGO_URI,
+    maxPoolSize=200,
+    minPoolSize=10,
+    maxIdleTimeMS=300000,
+    retryWrites=True,
+    w=1,
+    compressors="zstd"
+)
 db = client["posh"]
 users_collection = db["users"]
 authorized_emails_collection = db["authorized_emails"]
@@ -38,21 +54,78 @@ if not SECRET_KEY:
 
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+_JWT_KEY = SECRET_KEY.encode()
+
+# Fixed HS256 header and keyed HMAC state, reused for every issued token
+_JWT_HEADER_B64 = base64url_encode(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+_HMAC_TEMPLATE = hmac.new(_JWT_KEY, digestmod=hashlib.sha256)
+
+# Short-lived cache of verified tokens: sha256(token) -> (TokenData, exp)
+_token_cache = TTLCache(maxsize=10000, ttl=5)
+_token_cache_lock = threading.Lock()
+
+# Authorized-email lookups: lowercased email -> (is_authorized, name)
+_authorized_email_cache = TTLCache(maxsize=2048, ttl=300)
+
+# Bloom filter of authorized emails; None until loaded or if the watcher stops
+_authorized_bloom: ScalableBloomFilter | None = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        client.admin.command("ping")
+        await client.admin.command("ping")
         print("Successfully connected to MongoDB Atlas!")
     except ConnectionFailure as e:
         print("MongoDB connection failed:", e)
+
+    # Each index is built independently so one failure doesn't skip the rest
+    indexes = [
+        ("users.email", users_collection, "email", {"unique": True}),
+        ("authorized_emails.email", authorized_emails_collection, "email", {"unique": True}),
+        # Covers the leaderboard query so it is answered from the index alone
+        ("users.quiz_score leaderboard", users_collection,
+         [("quiz_score", -1), ("email", 1), ("name", 1), ("quiz_time", 1), ("quiz_date", 1)],
+         {"partialFilterExpression": {"quiz_score": {"$exists": True}}}),
+    ]
+    for label, collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except PyMongoError as e:
+            print(f"MongoDB index creation failed for {label}:", e)
+
+    bloom_task = asyncio.create_task(_watch_authorized_emails())
     yield
+    bloom_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await bloom_task
 
 app = FastAPI(title="POSH Training Auth API", lifespan=lifespan)
 
 # ==============================
 # Custom Exception Handler
 # ==============================
+# Static parts of the error bodies, built once at import
+_UNAUTHORIZED_BASE = {
+    "error": True,
+    "error_code": "UNAUTHORIZED",
+    "message": "Unauthorized Access",
+    "suggestions": [
+        "Ensure you are logged in with a valid token",
+        "Your session may have expired - please login again",
+        "Check that the Authorization header is properly set"
+    ]
+}
+
+_NOT_FOUND_BASE = {
+    "error": True,
+    "error_code": "NOT_FOUND",
+    "message": "Resource Not Found",
+    "suggestions": [
+        "Check the URL you are trying to access",
+        "Ensure the resource exists"
+    ]
+}
+
 @app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request: Request, exc: HTTPException):
     """
@@ -61,31 +134,12 @@ async def custom_http_exception_handler(request: Request, exc: HTTPException):
     if exc.status_code == 401:
         return JSONResponse(
             status_code=401,
-            content={
-                "error": True,
-                "error_code": "UNAUTHORIZED",
-                "message": "Unauthorized Access",
-                "details": exc.detail,
-                "suggestions": [
-                    "Ensure you are logged in with a valid token",
-                    "Your session may have expired - please login again",
-                    "Check that the Authorization header is properly set"
-                ]
-            }
+            content={**_UNAUTHORIZED_BASE, "details": exc.detail}
         )
     elif exc.status_code == 404:
         return JSONResponse(
             status_code=404,
-            content={
-                "error": True,
-                "error_code": "NOT_FOUND",
-                "message": "Resource Not Found",
-                "details": exc.detail,
-                "suggestions": [
-                    "Check the URL you are trying to access",
-                    "Ensure the resource exists"
-                ]
-            }
+            content={**_NOT_FOUND_BASE, "details": exc.detail}
         )
     else:
         return JSONResponse(
@@ -106,17 +160,15 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=[
+    allow_methods=("GET", "POST"),
+    allow_headers=(
         "Authorization",
         "Content-Type",
         "Accept",
-        "Origin",
-        "User-Agent",
-        "DNT",
         "Cache-Control",
         "X-Requested-With"
-    ],
+    ),
+    max_age=86400,  # let browsers cache preflight responses for 24h
 )
 
 # ==============================
@@ -125,10 +177,13 @@ app.add_middleware(
 security = HTTPBearer()
 
 class Token(BaseModel):
+    error: bool = False
     access_token: str
     token_type: str
     email: str
     login_count: int
+    message: str
+    user_name: str
 
 class TokenData(BaseModel):
     email: str | None = None
@@ -148,40 +203,267 @@ class ErrorResponse(BaseModel):
 
 class QuizScore(BaseModel):
     email: str
+    name: str | None = None
+    quiz_score: int
+    quiz_time: str | None = None
+    quiz_date: str | None = None
+
+class Leaderboard(BaseModel):
+    error: bool = False
+    leaderboard: list[QuizScore]
+
+class UserQuizScore(BaseModel):
+    error: bool = False
+    email: str
+    quiz_score: int | None = None
+    quiz_time: str | None = None
+    quiz_date: str | None = None
+
+class QuizSubmitted(BaseModel):
+    error: bool = False
+    message: str
     score: int
     quiz_time: str
     quiz_date: str
 
+class Message(BaseModel):
+    message: str
+
+class SlideEnded(BaseModel):
+    message: str
+    total_time: float
+
 # ==============================
 # Utility Functions
 # ==============================
+_ASCII_LETTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_ASCII_ALNUM = _ASCII_LETTERS + "0123456789"
+# Translation tables that delete every allowed character
+_LOCAL_PART_CHARS = str.maketrans("", "", _ASCII_ALNUM + "._%+-")
+_DOMAIN_CHARS = str.maketrans("", "", _ASCII_ALNUM + ".-")
+_TLD_CHARS = str.maketrans("", "", _ASCII_LETTERS)
+
 def is_valid_email(email: str) -> bool:
     """
-    Validate email format using regex
+    Validate email format without regex (local@domain.tld)
     """
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(email_pattern, email) is not None
+    at = email.rfind("@")
+    if at < 1 or at > 64:
+        return False
+    local, domain = email[:at], email[at + 1:]
+    if local.translate(_LOCAL_PART_CHARS) or domain.translate(_DOMAIN_CHARS):
+        return False
+    dot = domain.rfind(".")
+    tld = domain[dot + 1:]
+    return dot >= 1 and len(tld) >= 2 and not tld.translate(_TLD_CHARS)
+
+async def _lookup_authorized_email(email: str) -> tuple[bool, str]:
+    """
+    Cached authorized_emails lookup; expects an already lowercased email.
+    Errors propagate so failed lookups are never cached.
+    """
+    cached = _authorized_email_cache.get(email)
+    if cached is not None:
+        return cached
 
-def is_email_authorized(email: str) -> tuple[bool, str]:
+    result = await authorized_emails_collection.find_one({"email": email}, {"name": 1})
+    if result:
+        entry = (True, result["name"])
+    else:
+        entry = (False, "")
+    _authorized_email_cache[email] = entry
+    return entry
+
+def _authorized_doc_email(doc: dict | None) -> str | None:
+    """
+    Lowercased email of an authorized_emails document, or None (logged)
+    when the field is missing or not a string.
+    """
+    if doc is None:
+        return None
+    email = doc.get("email")
+    if not isinstance(email, str):
+        print(f"Skipping authorized_emails document {doc.get('_id')}: invalid email {email!r}")
+        return None
+    return email.lower()
+
+async def _watch_authorized_emails():
+    """
+    Load authorized emails into the Bloom filter and keep it current from a
+    change stream. The stream is opened before the initial load so no insert
+    is missed. Deletions cannot be removed from a Bloom filter; they still
+    fall through to Mongo. While the stream is down the filter is disabled
+    and the load is retried with exponential backoff.
+    """
+    global _authorized_bloom
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "replace", "update"]}}}]
+    delay = 1.0
+    try:
+        while True:
+            try:
+                async with await authorized_emails_collection.watch(pipeline, full_document="updateLookup") as stream:
+                    bloom = ScalableBloomFilter(initial_capacity=10000, error_rate=1e-4)
+                    async for doc in authorized_emails_collection.find({}, {"email": 1}):
+                        email = _authorized_doc_email(doc)
+                        if email:
+                            bloom.add(email)
+                    _authorized_bloom = bloom
+                    delay = 1.0
+
+                    async for change in stream:
+                        email = _authorized_doc_email(change.get("fullDocument"))
+                        if email:
+                            bloom.add(email)
+                            # Drop stale "not authorized" results and old names
+                            _authorized_email_cache.pop(email, None)
+            except PyMongoError as e:
+                print(f"Authorized email filter disabled, retrying in {delay:.0f}s:", e)
+            _authorized_bloom = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+    finally:
+        _authorized_bloom = None
+
+async def is_email_authorized(email: str) -> tuple[bool, str]:
     """
     Check if an email is in the authorized_emails collection
     Returns: (is_authorized: bool, name: str)
     """
+    email = email.lower()
+    # Definite misses skip the database entirely
+    if _authorized_bloom is not None and email not in _authorized_bloom:
+        return False, ""
+
     try:
-        result = authorized_emails_collection.find_one({"email": email.lower()})
-        if result:
-            return True, result["name"]
-        else:
-            return False, ""
+        return await _lookup_authorized_email(email)
     except Exception as e:
         print(f"Error checking email authorization: {e}")
         return False, ""
 
+async def _merge_user(claimed: dict, email_n: str):
+    """
+    Fold a claimed (already deleted) user document into the user stored
+    under email_n with atomic operators, or re-insert it under email_n.
+    """
+    update = {
+        "$inc": {
+            "login_count": claimed.get("login_count", 0),
+            "total_login_time": claimed.get("total_login_time", 0.0)
+        },
+        "$max": {"completed_slides": claimed.get("completed_slides", 0)}
+    }
+    if claimed.get("status") == "completed":
+        update["$set"] = {"status": "completed"}
+        if claimed.get("finished_at"):
+            update["$max"]["finished_at"] = claimed["finished_at"]
+
+    while True:
+        result = await users_collection.update_one({"email": email_n}, update)
+        if result.matched_count:
+            break
+        try:
+            await users_collection.insert_one({**claimed, "email": email_n})
+            return
+        except DuplicateKeyError:
+            continue  # a login created the user meanwhile; merge into it
+
+    # Keep the better quiz attempt
+    score = claimed.get("quiz_score")
+    if score is not None:
+        await users_collection.update_one(
+            {"email": email_n, "$or": [{"quiz_score": {"$lt": score}}, {"quiz_score": None}]},
+            {"$set": {field: claimed.get(field) for field in ("quiz_score", "quiz_time", "quiz_date")}}
+        )
+
+async def normalize_user_emails():
+    """
+    One-off migration: users used to be stored with the email as typed, so
+    lowercase them and merge case-duplicates into the lowercased document.
+    Run with `python PoshBackend.py migrate-emails`; safe alongside running
+    workers since each document is claimed with find_one_and_delete.
+    """
+    # The unique index makes the re-insert in _merge_user race-free
+    await users_collection.create_index("email", unique=True)
+
+    mixed_case = users_collection.find({"$expr": {"$ne": ["$email", {"$toLower": "$email"}]}})
+    async for doc in mixed_case:
+        claimed = await users_collection.find_one_and_delete({"_id": doc["_id"]})
+        if claimed is None:
+            continue
+        email_n = claimed["email"].lower()
+        await _merge_user(claimed, email_n)
+        print(f"Normalized user {claimed['email']} -> {email_n}")
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=15))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    expire = datetime.now(timezone.utc) + (expires_delta if expires_delta else timedelta(minutes=15))
+    if ALGORITHM != "HS256":
+        to_encode.update({"exp": expire})
+        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+    to_encode.update({"exp": int(expire.timestamp())})
+    signing_input = _JWT_HEADER_B64 + b"." + base64url_encode(orjson.dumps(to_encode))
+    h = _HMAC_TEMPLATE.copy()
+    h.update(signing_input)
+    return (signing_input + b"." + base64url_encode(h.digest())).decode()
+
+_BASE64URL_ALPHABET = frozenset(_ASCII_ALNUM + "-_")
+
+def _decode_segment(segment: str, name: str) -> bytes:
+    """
+    Strictly decode one base64url token segment, as PyJWT does: only the
+    base64url alphabet, at most two '=' of padding, and the decoded bytes
+    must re-encode to the same segment so each token has one spelling.
+    """
+    stripped = segment.rstrip("=")
+    padding = len(segment) - len(stripped)
+    if padding > 2 or (padding and len(segment) % 4 != 0):
+        raise jwt.DecodeError(f"Invalid {name} padding")
+    if len(stripped) % 4 == 1 or not _BASE64URL_ALPHABET.issuperset(stripped):
+        raise jwt.DecodeError(f"Invalid {name} padding")
+
+    decoded = base64url_decode(stripped)
+    if base64url_encode(decoded) != stripped.encode():
+        raise jwt.DecodeError(f"Invalid {name} padding")
+    return decoded
+
+def decode_access_token(token: str) -> dict:
+    """
+    Verify and decode a JWT. HS256 tokens are checked with hmac and parsed
+    with orjson; any other algorithm goes through PyJWT.
+    Raises jwt.PyJWTError subclasses on invalid tokens.
+    """
+    if ALGORITHM != "HS256":
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+    if token.count(".") != 2:
+        raise jwt.DecodeError("Not enough segments")
+    signing_input, _, signature_b64 = token.rpartition(".")
+    header_b64, _, payload_b64 = signing_input.partition(".")
+    header_data = _decode_segment(header_b64, "header")
+    payload_data = _decode_segment(payload_b64, "payload")
+    signature = _decode_segment(signature_b64, "signature")
+    try:
+        header = orjson.loads(header_data)
+        payload = orjson.loads(payload_data)
+    except ValueError as e:
+        raise jwt.DecodeError("Invalid token encoding") from e
+
+    if not isinstance(header, dict) or header.get("alg") != "HS256":
+        raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+    expected = hmac.new(_JWT_KEY, signing_input.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(expected, signature):
+        raise jwt.InvalidSignatureError("Signature verification failed")
+    if not isinstance(payload, dict):
+        raise jwt.DecodeError("Invalid payload")
+
+    exp = payload.get("exp")
+    if exp is not None:
+        if not isinstance(exp, (int, float)):
+            raise jwt.DecodeError("Expiration Time claim (exp) must be an integer.")
+        if exp <= time.time():
+            raise jwt.ExpiredSignatureError("Signature has expired")
+    return payload
 
 async def get_current_user(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
     credentials_exception = HTTPException(
@@ -189,31 +471,73 @@ async def get_current_user(credentials: Annotated[HTTPAuthorizationCredentials,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    key = hashlib.sha256(credentials.credentials.encode()).digest()
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+    if cached:
+        token_data, exp = cached
+        if exp > now:
+            return token_data
+        with _token_cache_lock:
+            _token_cache.pop(key, None)
+
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(credentials.credentials)
         email: str = payload.get("email")
         if email is None:
             raise credentials_exception
-        return TokenData(email=email)
+        token_data = TokenData(email=email.lower())
     except jwt.PyJWTError:
         raise credentials_exception
 
+    exp = payload.get("exp")
+    if exp is not None:
+        with _token_cache_lock:
+            _token_cache[key] = (token_data, exp)
+    return token_data
+
 # ==============================
 # Health Check Endpoint
 # ==============================
+# [monotonic time of last ping result, last ping succeeded]
+_last_ping = [0.0, True]
+# In-flight ping shared by concurrent probes
+_ping_task: asyncio.Task | None = None
+HEALTH_PING_TIMEOUT = 2.0
+
+async def _refresh_ping() -> bool:
+    global _ping_task
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=HEALTH_PING_TIMEOUT)
+        ok = True
+    except (PyMongoError, asyncio.TimeoutError):
+        ok = False
+    _last_ping[0] = time.monotonic()
+    _last_ping[1] = ok
+    _ping_task = None
+    return ok
+
 @app.get("/health")
 async def health_check():
-    try:
-        client.admin.command("ping")
-        return {"status": "ok", "message": "MongoDB connected"}
-    except ConnectionFailure:
+    global _ping_task
+    if time.monotonic() - _last_ping[0] >= 1.0:
+        if _ping_task is None:
+            _ping_task = asyncio.create_task(_refresh_ping())
+        # Shielded so a disconnecting probe doesn't cancel the shared ping
+        await asyncio.shield(_ping_task)
+
+    if not _last_ping[1]:
         raise HTTPException(status_code=500, detail="MongoDB not connected")
+    return {"status": "ok", "message": "MongoDB connected"}
 
 # ==============================
 # Endpoints
 # ==============================
-@app.post("/auth")
+@app.post("/auth", response_model=Token | ErrorResponse)
 async def authenticate_user(email: Annotated[str, Form()]):
+    email_n = email.lower()
+
     # First, validate email format
     if not is_valid_email(email):
         return {
@@ -229,7 +553,7 @@ async def authenticate_user(email: Annotated[str, Form()]):
         }
 
     # Check if email is authorized
-    is_authorized, name = is_email_authorized(email)
+    is_authorized, name = await is_email_authorized(email_n)
     if not is_authorized:
         return {
             "error": True,
@@ -245,107 +569,105 @@ async def authenticate_user(email: Annotated[str, Form()]):
         }
 
     # Proceed with existing logic if email is authorized
-    user = users_collection.find_one({"email": email})
-    if user:
-        login_count = user["login_count"] + 1
-        users_collection.update_one({"email": email}, {"$set": {"login_count": login_count}})
-    else:
-        user_id = str(uuid.uuid4())
-        user = {
-            "_id": user_id,
-            "email": email,
-            "name": name,  # Add the name from authorized_emails
-            "completed_slides": 0,  # start with 0
-            "total_login_time": 0.0,
-            "login_count": 1,
-            "status": "in_progress",
-            "start_time": None
-        }
-        users_collection.insert_one(user)
-        login_count = 1
+    # Atomically bump login_count, creating the user on first login
+    user = await users_collection.find_one_and_update(
+        {"email": email_n},
+        {
+            "$inc": {"login_count": 1},
+            "$setOnInsert": {
+                "_id": str(uuid.uuid4()),
+                "name": name,  # Add the name from authorized_emails
+                "completed_slides": 0,  # start with 0
+                "total_login_time": 0.0,
+                "status": "in_progress",
+                "start_time": None
+            }
+        },
+        upsert=True,
+        projection={"login_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    login_count = user["login_count"]
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"email": email}, expires_delta=access_token_expires
+        data={"email": email_n}, expires_delta=access_token_expires
     )
     return {
         "error": False,
         "access_token": access_token,
         "token_type": "bearer",
-        "email": email,
+        "email": email_n,
         "login_count": login_count,
         "message": "Authentication successful",
         "user_name": name
     }
 
-@app.post("/progress/start")
+@app.post("/progress/start", response_model=Message)
 async def start_slide(
     current_user: Annotated[TokenData, Depends(get_current_user)],
     slide_id: Annotated[int, Form()]
 ):
-    user = users_collection.find_one({"email": current_user.email})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    start_time = datetime.utcnow()
-    users_collection.update_one(
+    start_time = datetime.now(timezone.utc)
+    result = await users_collection.update_one(
         {"email": current_user.email},
         {"$set": {"current_slide": slide_id, "start_time": start_time}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
     return {"message": f"Slide {slide_id} started at {start_time}"}
 
-@app.post("/progress/end")
+@app.post("/progress/end", response_model=SlideEnded)
 async def end_slide(
     current_user: Annotated[TokenData, Depends(get_current_user)],
     slide_id: Annotated[int, Form()]
 ):
-    user = users_collection.find_one({"email": current_user.email})
+    # Single atomic round-trip: login time and max slide are computed server-side
+    user = await users_collection.find_one_and_update(
+        {"email": current_user.email},
+        [{"$set": {
+            # ✅ Only keep the maximum slide number
+            "completed_slides": {"$max": [{"$ifNull": ["$completed_slides", 0]}, slide_id]},
+            # Calculate login time automatically (in minutes)
+            "total_login_time": {"$add": [
+                {"$ifNull": ["$total_login_time", 0.0]},
+                {"$cond": [
+                    {"$ifNull": ["$start_time", False]},
+                    {"$divide": [
+                        {"$dateDiff": {"startDate": "$start_time", "endDate": "$$NOW", "unit": "millisecond"}},
+                        60000
+                    ]},
+                    0.0
+                ]}
+            ]},
+            "end_time": "$$NOW"
+        }}],
+        projection={"end_time": 1, "total_login_time": 1},
+        return_document=ReturnDocument.AFTER
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    end_time = datetime.utcnow()
-    
-    # Calculate login time automatically
-    start_time = user.get("start_time")
-    if start_time:
-        login_time = (end_time - start_time).total_seconds() / 60  # in minutes
-    else:
-        login_time = 0.0
-
-    total_time = user.get("total_login_time", 0.0) + login_time
-
-    # ✅ Only keep the maximum slide number
-    current_max = user.get("completed_slides", 0)
-    if slide_id > current_max:
-        completed_slides = slide_id
-    else:
-        completed_slides = current_max
-
-    users_collection.update_one(
-        {"email": current_user.email},
-        {"$set": {
-            "completed_slides": completed_slides,
-            "total_login_time": total_time,
-            "end_time": end_time
-        }}
-    )
+    end_time = user["end_time"]
+    total_time = user["total_login_time"]
     return {"message": f"Slide {slide_id} ended at {end_time}", "total_time": total_time}
 
-@app.post("/progress/finish")
+@app.post("/progress/finish", response_model=Message)
 async def finish_training(current_user: Annotated[TokenData, Depends(get_current_user)]):
-    user = users_collection.find_one({"email": current_user.email})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    users_collection.update_one(
+    result = await users_collection.update_one(
         {"email": current_user.email},
-        {"$set": {"status": "completed", "finished_at": datetime.utcnow()}}
+        {"$set": {"status": "completed", "finished_at": datetime.now(timezone.utc)}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
     return {"message": "Training completed ✅"}
 
 @app.get("/progress", response_model=Progress)
 async def get_progress(current_user: Annotated[TokenData, Depends(get_current_user)]):
-    user = users_collection.find_one({"email": current_user.email})
+    user = await users_collection.find_one(
+        {"email": current_user.email},
+        {"completed_slides": 1, "total_login_time": 1, "login_count": 1, "status": 1}
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -359,7 +681,7 @@ async def get_progress(current_user: Annotated[TokenData, Depends(get_current_us
 @app.get("/check-email/{email}")
 async def check_email_authorization(email: str):
     """Check if an email is authorized (for admin purposes)"""
-    is_authorized, name = is_email_authorized(email)
+    is_authorized, name = await is_email_authorized(email)
     return {
         "email": email,
         "is_authorized": is_authorized,
@@ -369,7 +691,7 @@ async def check_email_authorization(email: str):
 # ==============================
 # Quiz Endpoints
 # ==============================
-@app.post("/quiz/submit")
+@app.post("/quiz/submit", response_model=QuizSubmitted)
 async def submit_quiz_score(
     current_user: Annotated[TokenData, Depends(get_current_user)],
     score: Annotated[int, Form()]
@@ -377,34 +699,41 @@ async def submit_quiz_score(
     """
     Submit quiz score to users table
     """
-    now = datetime.now()
+    now = datetime.now(timezone.utc)
+    quiz_time = now.strftime("%H:%M:%S")
+    quiz_date = now.strftime("%Y-%m-%d")
 
     # Update user record with quiz score, time, and date
-    users_collection.update_one(
+    result = await users_collection.update_one(
         {"email": current_user.email},
         {
             "$set": {
                 "quiz_score": score,
-                "quiz_time": now.strftime("%H:%M:%S"),
-                "quiz_date": now.strftime("%Y-%m-%d")
+                "quiz_time": quiz_time,
+                "quiz_date": quiz_date
             }
         }
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
 
     return {
         "error": False,
         "message": "Quiz score submitted successfully",
         "score": score,
-        "quiz_time": now.strftime("%H:%M:%S"),
-        "quiz_date": now.strftime("%Y-%m-%d")
+        "quiz_time": quiz_time,
+        "quiz_date": quiz_date
     }
 
-@app.get("/quiz/score")
+@app.get("/quiz/score", response_model=UserQuizScore)
 async def get_user_quiz_score(current_user: Annotated[TokenData, Depends(get_current_user)]):
     """
     Get quiz score for the authenticated user
     """
-    user = users_collection.find_one({"email": current_user.email})
+    user = await users_collection.find_one(
+        {"email": current_user.email},
+        {"quiz_score": 1, "quiz_time": 1, "quiz_date": 1}
+    )
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -417,13 +746,13 @@ async def get_user_quiz_score(current_user: Annotated[TokenData, Depends(get_cur
         "quiz_date": user.get("quiz_date")
     }
 
-@app.get("/quiz/leaderboard")
+@app.get("/quiz/leaderboard", response_model=Leaderboard)
 async def get_quiz_leaderboard(limit: int = 10):
     """
     Get top quiz scores (leaderboard)
     """
     # Get users with quiz scores, sorted by score
-    leaderboard = list(users_collection.find(
+    leaderboard = await users_collection.find(
         {"quiz_score": {"$exists": True}},
         {
             "_id": 0,
@@ -433,7 +762,7 @@ async def get_quiz_leaderboard(limit: int = 10):
             "quiz_time": 1,
             "quiz_date": 1
         }
-    ).sort("quiz_score", -1).limit(limit))
+    ).sort("quiz_score", -1).limit(limit).to_list(None)
 
     return {
         "error": False,
@@ -444,7 +773,19 @@ async def get_quiz_leaderboard(limit: int = 10):
 # Run App
 # ==============================
 if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["migrate-emails"]:
+        asyncio.run(normalize_user_emails())
+        sys.exit(0)
+
     import uvicorn
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host=HOST, port=PORT)
+    WORKERS = int(os.getenv("WORKERS", "2"))
+    # Import string is required by uvicorn when running multiple workers
+    uvicorn.run(
+        "PoshBackend:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS
+    )